@@ -1,9 +1,40 @@
-from flask import Flask, render_template, request, jsonify
+# Patch blocking I/O before anything else is imported so the speech
+# recognition HTTP calls yield to other requests
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, Response, render_template, request
+import orjson
+from flask_caching import Cache
 import os
+import re
+import functools
+import logging
+import logging.handlers
+import shutil
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from gevent.threadpool import ThreadPoolExecutor
 from fsa_processor import process_fsa_image
 from chatbot import FSAChatbot
 
+# Buffer log records and write them out in batches of up to 512 rather than
+# per request. Only ERROR and above flush straight away, so INFO lines can
+# show up late; whatever is left is flushed when logging shuts down at exit
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.handlers.MemoryHandler(capacity=512, target=_log_stream)]
+)
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
+app.config["MAX_CONTENT_LENGTH"] = 8 * 1024 * 1024  # Reject oversized uploads up front
+cache = Cache(app, config={"CACHE_TYPE": "SimpleCache", "CACHE_DEFAULT_TIMEOUT": 3600})
 
 @app.route("/")
 def home():
@@ -11,8 +42,89 @@ def home():
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+def json_response(obj, status=200):
+    """
+    Serialize a response body with orjson; sets are sent as lists.
+    """
+    return Response(orjson.dumps(obj, default=list), status=status, mimetype="application/json")
+
+_ALLOWED_EXTENSION_RE = re.compile(
+    r"\.(?:%s)\Z" % "|".join(sorted(ALLOWED_EXTENSIONS)), re.IGNORECASE
+)
+
+@functools.lru_cache(maxsize=1024)
+def allowed_file(filename: str) -> bool:
+    return bool(_ALLOWED_EXTENSION_RE.search(filename))
+
+# Chatbots are cached per FSA so repeated questions don't rebuild them
+CHATBOT_CACHE_SIZE = 64
+_CHATBOT_CACHE = OrderedDict()
+_CHATBOT_CACHE_LOCK = threading.Lock()
+
+def fsa_cache_key(fsa_data):
+    payload = orjson.dumps(fsa_data, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+def get_chatbot(fsa_data, key=None):
+    """
+    Return the cached chatbot for this FSA, creating it on first use.
+    """
+    if key is None:
+        key = fsa_cache_key(fsa_data)
+    with _CHATBOT_CACHE_LOCK:
+        chatbot = _CHATBOT_CACHE.get(key)
+        if chatbot is not None:
+            _CHATBOT_CACHE.move_to_end(key)
+            return chatbot
+        
+        chatbot = FSAChatbot(fsa_data)
+        _CHATBOT_CACHE[key] = chatbot
+        if len(_CHATBOT_CACHE) > CHATBOT_CACHE_SIZE:
+            _CHATBOT_CACHE.popitem(last=False)
+        return chatbot
+
+def cached_answer(fsa_key, chatbot, question):
+    """
+    Answer a question, reusing the stored answer if this FSA was asked it before.
+    Answers only depend on the FSA and the lowercased question.
+    """
+    question = question.lower()
+    answer_key = f"answer:{fsa_key}:{question}"
+    response = cache.get(answer_key)
+    if response is None:
+        response = chatbot.answer_question(question)
+        cache.set(answer_key, response)
+    return response
+
+# Voice questions are captured and transcribed off the request thread;
+# the client polls /ask_result/<job_id> for the answer. The pool runs on
+# native threads, so blocking PortAudio reads never stall the gevent hub.
+VOICE_WORKERS = 16
+_VOICE_EXECUTOR = ThreadPoolExecutor(max_workers=VOICE_WORKERS)
+VOICE_JOB_TTL = 5 * 60  # Seconds a finished voice answer waits to be collected
+_VOICE_JOBS = {}  # job id -> (submit time, future)
+
+def prune_voice_jobs():
+    """
+    Forget finished voice jobs whose answer was not collected within VOICE_JOB_TTL.
+    """
+    cutoff = time.monotonic() - VOICE_JOB_TTL
+    for job_id, (submitted, future) in list(_VOICE_JOBS.items()):
+        if submitted < cutoff and future.done():
+            _VOICE_JOBS.pop(job_id, None)
+
+def answer_voice_question(fsa_key, chatbot):
+    """
+    Listen for a spoken question and answer it.
+    """
+    question = chatbot.listen()
+    if not question:
+        return {"response": "No question detected. Please try again."}
+    
+    response = cached_answer(fsa_key, chatbot, question)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Chatbot response: %s", response)
+    return {"response": response, "question": question}
 
 @app.route("/ask", methods=["POST"])
 def ask():
@@ -22,71 +134,125 @@ def ask():
     voice_input = data.get("voice_input", False)
     
     if not fsa_data:
-        return jsonify({"error": "Invalid request - missing FSA data"}), 400
+        return json_response({"error": "Invalid request - missing FSA data"}, 400)
     
-    print("Received FSA data:", fsa_data)
+    logger.debug("Received FSA data: %s", fsa_data)
     
     try:
-        # Initialize the chatbot with the FSA data
-        chatbot = FSAChatbot(fsa_data)
+        # Reuse the chatbot for this FSA if we've seen it before
+        fsa_key = fsa_cache_key(fsa_data)
+        chatbot = get_chatbot(fsa_data, fsa_key)
         
-        # Handle voice input
+        # Handle voice input in the background and hand back a job id
         if voice_input:
-            question = chatbot.listen()
-            if not question:
-                return jsonify({"response": "No question detected. Please try again."})
+            prune_voice_jobs()
+            job_id = uuid.uuid4().hex
+            future = _VOICE_EXECUTOR.submit(answer_voice_question, fsa_key, chatbot)
+            _VOICE_JOBS[job_id] = (time.monotonic(), future)
+            return json_response({"job_id": job_id}, 202)
         
-        # If no question provided (for voice input case)
+        # If no question provided
         if not question:
-            return jsonify({"response": "No question detected. Please try again."})
+            return json_response({"response": "No question detected. Please try again."})
         
         # Get the response from the chatbot
-        response = chatbot.answer_question(question)
-        
-        # Clean up resources
-        del chatbot
+        response = cached_answer(fsa_key, chatbot, question)
         
-        print("Chatbot response:", response)
-        return jsonify({
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Chatbot response: %s", response)
+        return json_response({
             "response": response, 
             "question": question if question else "Voice question"
         })
     except Exception as e:
-        print("Error in chatbot:", str(e))
-        return jsonify({"error": str(e)}), 500
+        logger.error("Error in chatbot: %s", e)
+        return json_response({"error": str(e)}, 500)
+
+@app.route("/ask_result/<job_id>", methods=["GET"])
+def ask_result(job_id):
+    job = _VOICE_JOBS.get(job_id)
+    if job is None:
+        return json_response({"error": "Unknown voice question"}, 404)
+    
+    _, future = job
+    if not future.done():
+        return json_response({"pending": True}, 202)
+    
+    _VOICE_JOBS.pop(job_id, None)
+    try:
+        return json_response(future.result())
+    except Exception as e:
+        logger.error("Error in chatbot: %s", e)
+        return json_response({"error": str(e)}, 500)
+
+UPLOAD_FOLDER = os.path.join("static", "uploads")
+UPLOAD_MAX_AGE = 60 * 60  # Seconds an uploaded image is kept around
+_upload_folder_ready = False
+
+def ensure_upload_folder():
+    global _upload_folder_ready
+    if not _upload_folder_ready:
+        os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+        _upload_folder_ready = True
+
+def sweep_uploads():
+    """
+    Delete uploaded images older than UPLOAD_MAX_AGE, then reschedule.
+    """
+    cutoff = time.time() - UPLOAD_MAX_AGE
+    try:
+        with os.scandir(UPLOAD_FOLDER) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error("Error sweeping uploads: %s", e)
+    
+    timer = threading.Timer(UPLOAD_MAX_AGE / 4, sweep_uploads)
+    timer.daemon = True
+    timer.start()
+
+sweep_uploads()
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    limit_mb = app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)
+    return json_response({"error": f"File too large - the limit is {limit_mb} MB"}, 413)
 
 @app.route("/process_image", methods=["POST"])
 def process_image():
     if 'file' not in request.files:
-        return jsonify({"error": "No file uploaded"}), 400
+        return json_response({"error": "No file uploaded"}, 400)
     
     file = request.files['file']
     if file.filename == '':
-        return jsonify({"error": "No file selected"}), 400
+        return json_response({"error": "No file selected"}, 400)
     
     if not allowed_file(file.filename):
-        return jsonify({"error": "Invalid file type. Only PNG and JPG are allowed."}), 400
+        return json_response({"error": "Invalid file type. Only PNG and JPG are allowed."}, 400)
     
     # Save the uploaded file
-    upload_folder = "static"
-    if not os.path.exists(upload_folder):
-        os.makedirs(upload_folder)
-    
-    image_path = os.path.join(upload_folder, "uploaded_image.png")
-    file.save(image_path)
+    ensure_upload_folder()
+    # Each upload gets its own file so concurrent requests don't clobber each other
+    image_path = os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}.png")
+    with open(image_path, "wb", buffering=4 * 1024 * 1024) as out:
+        shutil.copyfileobj(file.stream, out, length=1024 * 1024)
     
     # Verify the file was saved
     if not os.path.exists(image_path):
-        return jsonify({"error": "Failed to save the uploaded image"}), 500
+        return json_response({"error": "Failed to save the uploaded image"}, 500)
     
     # Process the FSA image
     try:
         fsa_data = process_fsa_image(image_path)
-        return jsonify({"success": True, "fsa_data": fsa_data})
+        return json_response({"success": True, "fsa_data": fsa_data, "image_path": image_path})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
 # ========================== Main Function ==========================
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("0.0.0.0", 5000), app).serve_forever()
@@ -1,16 +1,308 @@
+import re
+import os
+import atexit
+import logging
+import queue
+import hashlib
+import tempfile
+import wave
 import speech_recognition as sr
-from typing import Dict
+from gevent.monkey import get_original
+from typing import Callable, Dict, Optional
 import pyttsx3
+import simpleaudio
+
+logger = logging.getLogger(__name__)
+
+# Every keyword the FSA rules look for, found in a single scan of the question;
+# the lookahead keeps overlapping keywords such as "final" and "list" in "finalist"
+_KEYWORD_RE = re.compile(r"(?=(states|transitions?|initial|final|input|from|what|list))")
+
+# Sentence boundaries used to split responses for speech
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+# Conceptual questions, one pattern per entry in CONCEPT_ANSWERS, tried in order
+_CONCEPT_RES = (
+    ("what_fsa", re.compile(r"what is (?:a|the) finite state automata|what is an fsa")),
+    ("what_state", re.compile(r"what is a state")),
+    ("what_transition", re.compile(r"what is a transition")),
+    ("what_input_symbol", re.compile(r"what is an input symbol|what are input symbols")),
+)
+
+CONCEPT_ANSWERS = {
+    "what_fsa": ("A Finite State Automaton (FSA) is a mathematical model of computation used to "
+                 "design both computer programs and sequential logic circuits. It consists of a "
+                 "finite number of states, transitions between these states, and actions."),
+    "what_state": ("A state is a condition or situation of the FSA at a given time. It represents "
+                   "a specific configuration of the system."),
+    "what_transition": ("A transition is a change from one state to another in response to an input symbol."),
+    "what_input_symbol": ("An input symbol is a character or token that triggers a transition between states "
+                          "in an FSA."),
+}
+
+DEFAULT_ANSWER = "Sorry, I don't understand that question. Please ask about the FSA states, transitions, or basic concepts."
+
+LISTEN_PROMPT = "Please ask your question now"
+LISTEN_TIMEOUT_MESSAGE = "I didn't hear anything. Please try again."
+LISTEN_UNKNOWN_MESSAGE = "Sorry, I couldn't understand your question. Please try again."
+LISTEN_SERVICE_ERROR_MESSAGE = "Sorry, there was an error with the speech recognition service."
+
+# Fixed phrases whose audio is rendered once and replayed from disk
+CANNED_SPEECH = (
+    LISTEN_PROMPT,
+    LISTEN_TIMEOUT_MESSAGE,
+    LISTEN_UNKNOWN_MESSAGE,
+    LISTEN_SERVICE_ERROR_MESSAGE,
+    DEFAULT_ANSWER,
+    *CONCEPT_ANSWERS.values(),
+)
+
+TTS_CACHE_DIR = os.path.join(tempfile.gettempdir(), "fsa_bot_tts")
+
+# Rules 1-5 as (rule, keyword, any-of keywords also required), in priority order
+_FSA_RULES = (
+    ("states", "states", frozenset(("what", "list"))),
+    ("transitions", "transitions", None),
+    ("initial_state", "initial", None),
+    ("final_state", "final", None),
+    ("input_symbol", "input", frozenset(("transition", "transitions", "from"))),
+)
+
+def state_sort_key(state: Dict) -> int:
+    """
+    Sort key used when listing the states of an FSA.
+    """
+    if 'final' in state['type']:
+        return 0  # Final states come first
+    elif 'normal' in state['type']:
+        return 1  # Normal states come second
+    elif 'initial' in state['type']:
+        return 2  # Initial states come last
+    else:
+        return 3  # Any other type (if exists)
+
+def input_symbol_answer(question: str, edge_index: Dict) -> str:
+    """
+    Rule 5: What is the input symbol for the transition from state X to state Y?
+    """
+    try:
+        # Extract numbers from the question that might be state IDs
+        numbers = [int(s) for s in question.split() if s.isdigit()]
+        
+        if len(numbers) >= 2:
+            source = numbers[0]
+            dest = numbers[1]
+            
+            # Look up the transition in the rules
+            label = edge_index.get((source, dest))
+            if label is None:
+                return f"No transition found from State {source} to State {dest}."
+            return f"The input symbol for the transition from State {source} to State {dest} is '{label}'."
+        return "Please specify both the source and destination states in your question."
+    except:
+        return "Sorry, I couldn't understand the states in your question. Please try asking again."
+
+# The TTS engine and speech worker are shared by every chatbot, since they all
+# play through the same audio output; each queued sentence is paired with the
+# lock released once it has been spoken, or None. They are built from the
+# unpatched thread primitives so the worker is a native thread even when
+# gevent has monkey-patched the app, not a greenlet on a pool thread's hub
+_start_new_thread = get_original("_thread", "start_new_thread")
+_allocate_lock = get_original("_thread", "allocate_lock")
+_engine = None
+_speech_queue = get_original("queue", "SimpleQueue")()
+_speech_started = False
+_speech_lock = _allocate_lock()
+
+# Canned phrase -> rendered wav file
+_TTS_CACHE: Dict[str, str] = {}
+
+def get_engine():
+    """
+    Text-to-speech engine, initialized on first use.
+    """
+    global _engine
+    if _engine is None:
+        _engine = pyttsx3.init()
+        _engine.setProperty('rate', 120)
+    return _engine
+
+def speak(text: str, wait: bool = True):
+    """
+    Speak the text one sentence at a time from a background thread, so
+    the first sentence plays while the rest are still queued.
+    """
+    global _speech_started
+    # Drop anything left over from a previous response
+    while True:
+        try:
+            _, done = _speech_queue.get_nowait()
+        except queue.Empty:
+            break
+        if done is not None:
+            done.release()
+    
+    # Canned phrases are played whole from their cached audio
+    if text in CANNED_SPEECH:
+        sentences = [text]
+    else:
+        sentences = [sentence for sentence in _SENTENCE_RE.split(text) if sentence]
+    if not sentences:
+        return
+    done = _allocate_lock()
+    done.acquire()
+    for sentence in sentences[:-1]:
+        _speech_queue.put((sentence, None))
+    _speech_queue.put((sentences[-1], done))
+    
+    with _speech_lock:
+        if not _speech_started:
+            _start_new_thread(_speech_worker, ())
+            _speech_started = True
+    
+    if wait:
+        done.acquire()
+
+def _speech_worker():
+    """
+    Play queued sentences; the only thread that touches the TTS engine.
+    Canned phrases are rendered to disk whenever the queue is idle.
+    """
+    to_render = [text for text in CANNED_SPEECH if text not in _TTS_CACHE]
+    while True:
+        if to_render and _speech_queue.empty():
+            try:
+                _render_canned_speech(to_render.pop())
+            except Exception as e:
+                logger.error("Error rendering speech: %s", e)
+            continue
+        
+        sentence, done = _speech_queue.get()
+        try:
+            if not (sentence in CANNED_SPEECH and _play_canned_speech(sentence)):
+                engine = get_engine()
+                engine.say(sentence)
+                engine.runAndWait()
+        except Exception as e:
+            logger.error("Error in speaking: %s", e)
+        finally:
+            if done is not None:
+                done.release()
+
+def _play_canned_speech(text: str) -> bool:
+    """
+    Play the cached audio for a canned phrase; False if it is unavailable.
+    """
+    path = _render_canned_speech(text)
+    if path is None:
+        return False
+    try:
+        simpleaudio.WaveObject.from_wave_file(path).play().wait_done()
+    except Exception as e:
+        logger.warning("Could not play cached speech %s: %s", path, e)
+        return False
+    return True
+
+def _is_wave_file(path: str) -> bool:
+    """
+    Whether the path holds a readable, non-empty wav file.
+    """
+    try:
+        with wave.open(path, "rb") as wav:
+            return wav.getnframes() > 0
+    except (OSError, EOFError, wave.Error):
+        return False
+
+def _render_canned_speech(text: str) -> Optional[str]:
+    """
+    Return the wav file for a canned phrase, synthesizing it on first use,
+    or None if it could not be rendered.
+    """
+    path = _TTS_CACHE.get(text)
+    if path is None:
+        name = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+        path = os.path.join(TTS_CACHE_DIR, f"{name}.wav")
+        if not _is_wave_file(path):
+            # Render under a temporary name so a half-written file is never
+            # picked up, then move it into place once it checks out
+            tmp_path = None
+            try:
+                os.makedirs(TTS_CACHE_DIR, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(suffix=".wav", dir=TTS_CACHE_DIR)
+                os.close(fd)
+                engine = get_engine()
+                engine.save_to_file(text, tmp_path)
+                engine.runAndWait()
+                if not _is_wave_file(tmp_path):
+                    logger.warning("Rendered speech for %r is not a valid wav file", text)
+                    return None
+                os.replace(tmp_path, path)
+            except Exception as e:
+                logger.error("Error rendering speech: %s", e)
+                return None
+            finally:
+                if tmp_path is not None and os.path.exists(tmp_path):
+                    try:
+                        os.remove(tmp_path)
+                    except OSError as e:
+                        logger.warning("Could not remove %s: %s", tmp_path, e)
+        _TTS_CACHE[text] = path
+    return path
+
+# The microphone is a single device, so every chatbot records from one shared
+# stream, one question at a time
+_microphone = None
+_audio_source = None
+_listen_lock = _allocate_lock()
+
+def get_audio_source():
+    """
+    Microphone stream, opened on first use and kept open until
+    close_audio_source(). Callers must hold _listen_lock.
+    """
+    global _microphone, _audio_source
+    if _audio_source is None:
+        _microphone = sr.Microphone()
+        _audio_source = _microphone.__enter__()
+        atexit.register(close_audio_source)
+    return _audio_source
+
+def close_audio_source():
+    """
+    Close the shared microphone stream if it was opened.
+    """
+    global _audio_source
+    with _listen_lock:
+        if _audio_source is not None:
+            _audio_source = None
+            atexit.unregister(close_audio_source)
+            _microphone.__exit__(None, None, None)
 
 class FSAChatbot:
     def __init__(self, fsa_data: Dict):
         self.fsa_data = fsa_data
         self.rules = self._create_rules()
-        self.engine = pyttsx3.init()  # Initialize the text-to-speech engine
-        self.recognizer = sr.Recognizer()  # Initialize the speech recognizer
-        self.microphone = sr.Microphone()  # Initialize the microphone
+        self._handlers = self._create_handlers()
+        # Speech resources are created on first use so text-only questions
+        # never load the TTS driver or open the audio device
+        self._recognizer = None
+        self._calibrated = False
+
+    @property
+    def engine(self):
+        """
+        Shared text-to-speech engine.
+        """
+        return get_engine()
 
-        self.engine.setProperty('rate', 120)
+    @property
+    def recognizer(self):
+        """
+        Speech recognizer, initialized on first use.
+        """
+        if self._recognizer is None:
+            self._recognizer = sr.Recognizer()
+        return self._recognizer
         
     def _create_rules(self) -> Dict:
         """
@@ -19,54 +311,108 @@ class FSAChatbot:
         rules = {
             "states": self.fsa_data["states"],
             "transitions": self.fsa_data["transitions"],
-            "initial_state": None,
-            "final_state": None,
-            "input_symbols": set()
         }
         
-        # Identify initial and final states
+        # Identify initial and final states in a single pass
+        initial_state = final_state = None
         for state in rules["states"]:
-            if "Initial" in state["type"]:
-                rules["initial_state"] = state
-            if "Final" in state["type"]:
-                rules["final_state"] = state
+            state_type = state["type"]
+            if "Initial" in state_type:
+                initial_state = state
+            if "Final" in state_type:
+                final_state = state
+        rules["initial_state"] = initial_state
+        rules["final_state"] = final_state
         
         # Collect input symbols from transitions
+        rules["input_symbols"] = frozenset(t["label"] for t in rules["transitions"])
+        
+        # Index transition labels by (source, destination) for Rule 5,
+        # keeping the first label when an edge appears more than once.
+        # Ids are compared as given, like the original linear scan; edges
+        # whose ids can't be dict keys are skipped rather than failing the build
+        rules["edge_index"] = {}
         for transition in rules["transitions"]:
-            rules["input_symbols"].add(transition["label"])
+            edge = (transition["source"], transition["destination"])
+            try:
+                rules["edge_index"].setdefault(edge, transition["label"])
+            except TypeError:
+                logger.warning("Skipping transition with unhashable state ids: %s", edge)
+        
+        # The states and transitions answers only depend on the FSA, so build them once
+        sorted_states = sorted(rules["states"], key=state_sort_key)
+        states = [f"State {state['id']} ({', '.join(state['type'])})" 
+                  for state in sorted_states]
+        rules["states_answer"] = f"The states in the FSA are: {', '.join(states)}."
+        
+        transitions = [f"State {t['source']} -> State {t['destination']} (Input: '{t['label']}')" 
+                      for t in rules["transitions"]]
+        rules["transitions_answer"] = f"The transitions in the FSA are: {', '.join(transitions)}."
+        
+        if initial_state:
+            rules["initial_answer"] = f"The initial state is State {initial_state['id']}."
+        else:
+            rules["initial_answer"] = "No initial state detected."
+        
+        if final_state:
+            rules["final_answer"] = f"The final state is State {final_state['id']}."
+        else:
+            rules["final_answer"] = "No final state detected."
         
         return rules
 
-    def speak(self, text: str):
- 
-  
-        self.engine.stop()  # Stop any current speech
-        self.engine.say(text)
-        self.engine.runAndWait()
+    def _create_handlers(self) -> Dict[str, Callable[[str], str]]:
+        """
+        Build the answer function for each rule, specialized to this FSA.
+        Every answer except the input symbol lookup is a fixed string.
+        """
+        handlers = {
+            "states": lambda question, answer=self.rules["states_answer"]: answer,
+            "transitions": lambda question, answer=self.rules["transitions_answer"]: answer,
+            "initial_state": lambda question, answer=self.rules["initial_answer"]: answer,
+            "final_state": lambda question, answer=self.rules["final_answer"]: answer,
+            "input_symbol": lambda question, index=self.rules["edge_index"]: input_symbol_answer(question, index),
+        }
+        for name, answer in CONCEPT_ANSWERS.items():
+            handlers[name] = lambda question, answer=answer: answer
+        return handlers
+
+    def speak(self, text: str, wait: bool = True):
+        """
+        Speak the text through the shared speech worker.
+        """
+        speak(text, wait)
 
     def listen(self) -> str:
    
       try:
-        with self.microphone as source:
-            self.recognizer.adjust_for_ambient_noise(source)  # Adjust for noise
-            self.speak("Please ask your question now")
-            print("Listening...")
+        # Only one question can be recorded from the shared stream at a time
+        with _listen_lock:
+            source = get_audio_source()
+            
+            # Calibrate for background noise once; it is stable for the session
+            if not self._calibrated:
+                self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
+                self.recognizer.dynamic_energy_threshold = False
+                self._calibrated = True
+            self.speak(LISTEN_PROMPT)
+            logger.info("Listening...")
             audio = self.recognizer.listen(source, timeout=5, phrase_time_limit=10)
             
         question = self.recognizer.recognize_google(audio)
-        print(f"You asked: {question}")
+        logger.debug("You asked: %s", question)
         return question.lower()
       except sr.WaitTimeoutError:
-        self.speak("I didn't hear anything. Please try again.")
+        self.speak(LISTEN_TIMEOUT_MESSAGE)
         return ""
       except sr.UnknownValueError:
-        self.speak("Sorry, I couldn't understand your question. Please try again.")
+        self.speak(LISTEN_UNKNOWN_MESSAGE)
         return ""
       except sr.RequestError:
-        self.speak("Sorry, there was an error with the speech recognition service.")
+        self.speak(LISTEN_SERVICE_ERROR_MESSAGE)
         return ""
       except Exception as e:
-        print(f"Error in listening: {str(e)}")
+        logger.error("Error in listening: %s", e)
         return ""
 
     def answer_question(self, question: str) -> str:
@@ -78,86 +424,16 @@ class FSAChatbot:
             
         question = question.lower()
         
-        # Rule 1: What are the states in the given FSA?
-        if "states" in question and ("what" in question or "list" in question):
-            def sort_key(state):
-                if 'final' in state['type']:
-                    return 0  # Final states come first
-                elif 'normal' in state['type']:
-                    return 1  # Normal states come second
-                elif 'initial' in state['type']:
-                    return 2  # Initial states come last
-                else:
-                    return 3  # Any other type (if exists)
-
-            sorted_states = sorted(self.rules["states"], key=sort_key)
-            states = [f"State {state['id']} ({', '.join(state['type'])})" 
-                      for state in sorted_states]
-            response = f"The states in the FSA are: {', '.join(states)}."
-        
-        # Rule 2: What are the transitions in the given FSA?
-        elif "transitions" in question or "transitions" in question:  # Handling possible mispronunciation
-            transitions = [f"State {t['source']} -> State {t['destination']} (Input: '{t['label']}')" 
-                          for t in self.rules["transitions"]]
-            response = f"The transitions in the FSA are: {', '.join(transitions)}."
-        
-        # Rule 3: What is the initial state?
-        elif "initial state" in question or "initial" in question:
-            if self.rules["initial_state"]:
-                response = f"The initial state is State {self.rules['initial_state']['id']}."
-            else:
-                response = "No initial state detected."
-        
-        # Rule 4: What is the final state?
-        elif "final state" in question or "final" in question:
-            if self.rules["final_state"]:
-                response = f"The final state is State {self.rules['final_state']['id']}."
-            else:
-                response = "No final state detected."
-        
-        # Rule 5: What is the input symbol for the transition from state X to state Y?
-        elif ("input symbol" in question or "input" in question) and ("transition" in question or "from" in question):
-            try:
-                # Extract numbers from the question that might be state IDs
-                numbers = [int(s) for s in question.split() if s.isdigit()]
-                
-                if len(numbers) >= 2:
-                    source = numbers[0]
-                    dest = numbers[1]
-                    
-                    # Search for the transition in the rules
-                    for t in self.rules["transitions"]:
-                        if t["source"] == source and t["destination"] == dest:
-                            response = f"The input symbol for the transition from State {source} to State {dest} is '{t['label']}'."
-                            break
-                    else:
-                        response = f"No transition found from State {source} to State {dest}."
-                else:
-                    response = "Please specify both the source and destination states in your question."
-            except:
-                response = "Sorry, I couldn't understand the states in your question. Please try asking again."
+        # Rules 1-5: questions about the given FSA, tried in priority order
+        keywords = frozenset(_KEYWORD_RE.findall(question))
+        for rule, keyword, also_needs in _FSA_RULES:
+            if keyword in keywords and (also_needs is None or not keywords.isdisjoint(also_needs)):
+                return self._handlers[rule](question)
         
         # Rule 6: Basic conceptual questions about FSA
-        elif "what is a finite state automata" in question or "what is an fsa" in question or "what is the finite state automata" in question:
-            response = ("A Finite State Automaton (FSA) is a mathematical model of computation used to "
-                        "design both computer programs and sequential logic circuits. It consists of a "
-                        "finite number of states, transitions between these states, and actions.")
-        
-        elif "what is a state" in question:
-            response = ("A state is a condition or situation of the FSA at a given time. It represents "
-                        "a specific configuration of the system.")
-        
-        elif "what is a transition" in question:
-            response = ("A transition is a change from one state to another in response to an input symbol.")
-        
-        elif "what is an input symbol" in question or "what are input symbols" in question:
-            response = ("An input symbol is a character or token that triggers a transition between states "
-                        "in an FSA.")
+        for name, pattern in _CONCEPT_RES:
+            if pattern.search(question):
+                return self._handlers[name](question)
         
         # Default response
-        else:
-            response = "Sorry, I don't understand that question. Please ask about the FSA states, transitions, or basic concepts."
-        
-        # Speak the response
-       
-        return response
+        return DEFAULT_ANSWER
@@ -1,18 +1,36 @@
 import cv2
 import numpy as np
-import pytesseract
 from typing import Tuple, List, Dict
 import math
 import os
+import logging
 
-def preprocess_image(image_path: str) -> Tuple[np.ndarray, np.ndarray]:
+logger = logging.getLogger(__name__)
+
+# Set FSA_DEBUG=1 to save and show the annotated analysis image
+FSA_DEBUG = os.environ.get("FSA_DEBUG", "") not in ("", "0")
+
+# Half-angle of the arrow heads drawn on the analysis image
+_COS_ARROW = math.cos(math.pi / 6)
+_SIN_ARROW = math.sin(math.pi / 6)
+
+# Longest side, in pixels, that circle detection runs at; larger images are
+# downscaled first so huge photos don't blow up the Hough accumulator
+HOUGH_MAX_SIZE = 2048
+
+# 3x3 structuring element shared by the morphology operations
+_KERNEL3 = cv2.getStructuringElement(cv2.MORPH_RECT, (3, 3))
+
+def preprocess_image(image: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
     """
-    Preprocess the image for better state and transition detection.
+    Preprocess the loaded BGR image for better state and transition detection.
+    Returns the grayscale image and the threshold image.
+    When OpenCL is enabled the filtering runs on cv2.UMat so OpenCV can
+    offload it to the device; otherwise it stays on the NumPy arrays.
     """
-    image = cv2.imread(image_path)
-    if image is None:
-        raise ValueError("Could not load image")
-    
+    use_umat = cv2.ocl.useOpenCL()
+    if use_umat:
+        image = cv2.UMat(image)
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     blurred = cv2.GaussianBlur(gray, (5, 5), 0)
     
@@ -23,28 +41,35 @@ def preprocess_image(image_path: str) -> Tuple[np.ndarray, np.ndarray]:
     )
     
     # Clean up noise
-    kernel = np.ones((3, 3), np.uint8)
-    thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, kernel)
-    thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, kernel)
+    thresh = cv2.morphologyEx(thresh, cv2.MORPH_CLOSE, _KERNEL3)
+    thresh = cv2.morphologyEx(thresh, cv2.MORPH_OPEN, _KERNEL3)
     
-    return image, thresh
+    # The detectors below slice and index the images, so hand back arrays
+    if use_umat:
+        return gray.get(), thresh.get()
+    return gray, thresh
 
-def detect_circles(image: np.ndarray, thresh: np.ndarray) -> List[Dict]:
+def detect_circles(gray: np.ndarray, thresh: np.ndarray) -> List[Dict]:
     """
-    Detect circles (states) in the image using HoughCircles.
+    Detect circles (states) in the grayscale image using HoughCircles.
     """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if len(image.shape) == 3 else image.copy()
+    # Vote at a capped resolution; centers and radii are scaled back below
+    scale = min(1.0, HOUGH_MAX_SIZE / max(gray.shape[:2]))
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
     
     circles = cv2.HoughCircles(
         gray,
         cv2.HOUGH_GRADIENT,
         dp=1,
-        minDist=50,  # Increased minimum distance between circles
+        minDist=50 * scale,  # Increased minimum distance between circles
         param1=50,
         param2=30,
-        minRadius=20,
-        maxRadius=100
+        minRadius=int(20 * scale),
+        maxRadius=int(100 * scale)
     )
+    if circles is not None and scale < 1.0:
+        circles = circles / scale
     
     states = []
     if circles is not None:
@@ -71,43 +96,36 @@ def detect_initial_state_arrow(thresh: np.ndarray, states: List[Dict]) -> Dict:
     Detect the single initial state by finding the leftmost state with an incoming arrow.
     Returns a single state or None.
     """
-    leftmost_state = None
-    min_x = float('inf')
+    if not states:
+        return None
     
-    for state in states:
-        center = state['center']
-        radius = state['radius']
-        x, y = center
-        
-        # Find the leftmost state first
-        if x < min_x:
-            min_x = x
-            leftmost_state = state
-    
-    if leftmost_state:
-        x, y = leftmost_state['center']
-        radius = leftmost_state['radius']
-        
-        # Check region to the left of the state
-        search_region = max(0, x - int(radius * 3))
-        roi_left = thresh[
-            max(0, y - radius):min(thresh.shape[0], y + radius),
-            search_region:max(0, x - radius)
-        ]
+    # Find the leftmost state first
+    xs = np.fromiter((s['center'][0] for s in states), dtype=np.int32, count=len(states))
+    leftmost_state = states[int(xs.argmin())]
+    
+    x, y = leftmost_state['center']
+    radius = leftmost_state['radius']
+    
+    # Check region to the left of the state
+    search_region = max(0, x - int(radius * 3))
+    roi_left = thresh[
+        max(0, y - radius):min(thresh.shape[0], y + radius),
+        search_region:max(0, x - radius)
+    ]
+    
+    if roi_left.size > 0:
+        # The threshold image is already binary, so no edge pass is needed
+        lines = cv2.HoughLinesP(
+            roi_left, 1, np.pi/180, threshold=20,
+            minLineLength=radius, maxLineGap=10
+        )
         
-        if roi_left.size > 0:
-            edges = cv2.Canny(roi_left, 50, 150)
-            lines = cv2.HoughLinesP(
-                edges, 1, np.pi/180, threshold=20,
-                minLineLength=radius, maxLineGap=10
-            )
-            
-            if lines is not None:
-                for line in lines:
-                    x1, y1, x2, y2 = line[0]
-                    angle = abs(np.arctan2(y2 - y1, x2 - x1))
-                    if angle < np.pi/6:  # Almost horizontal
-                        return leftmost_state
+        if lines is not None:
+            for line in lines:
+                x1, y1, x2, y2 = line[0]
+                angle = abs(np.arctan2(y2 - y1, x2 - x1))
+                if angle < np.pi/6:  # Almost horizontal
+                    return leftmost_state
     
     return None
 
@@ -119,24 +137,30 @@ def detect_double_circles(thresh: np.ndarray, states: List[Dict]) -> Dict:
     best_final_state = None
     max_circle_score = 0
     
+    height, width = thresh.shape[:2]
+    
     for state in states:
-        center = state['center']
-        radius = state['radius']
+        cx, cy = int(state['center'][0]), int(state['center'][1])
+        radius = int(state['radius'])
+        
+        # Work in a window just large enough to hold the outer ring
+        pad = radius + 7
+        x0, y0 = max(0, cx - pad), max(0, cy - pad)
+        x1, y1 = min(width, cx + pad + 1), min(height, cy + pad + 1)
+        roi = thresh[y0:y1, x0:x1]
+        local_center = (cx - x0, cy - y0)
         
         # Create masks for inner and outer circles
-        inner_mask = np.zeros(thresh.shape, dtype=np.uint8)
-        outer_mask = np.zeros(thresh.shape, dtype=np.uint8)
+        inner_mask = np.zeros(roi.shape, dtype=np.uint8)
+        outer_mask = np.zeros(roi.shape, dtype=np.uint8)
         
         # Draw circles slightly smaller and larger than detected
-        cv2.circle(inner_mask, center, int(radius - 5), 255, 2)
-        cv2.circle(outer_mask, center, int(radius + 5), 255, 2)
-        
-        # Count white pixels in both rings
-        inner_pixels = cv2.bitwise_and(thresh, inner_mask)
-        outer_pixels = cv2.bitwise_and(thresh, outer_mask)
+        cv2.circle(inner_mask, local_center, radius - 5, 255, 2)
+        cv2.circle(outer_mask, local_center, radius + 5, 255, 2)
         
-        inner_count = np.count_nonzero(inner_pixels)
-        outer_count = np.count_nonzero(outer_pixels)
+        # Count white pixels in both rings, ANDing into the masks in place
+        inner_count = cv2.countNonZero(cv2.bitwise_and(roi, inner_mask, dst=inner_mask))
+        outer_count = cv2.countNonZero(cv2.bitwise_and(roi, outer_mask, dst=outer_mask))
         
         # Calculate score based on both rings
         circle_score = inner_count + outer_count
@@ -147,28 +171,7 @@ def detect_double_circles(thresh: np.ndarray, states: List[Dict]) -> Dict:
             max_circle_score = circle_score
             best_final_state = state
     
-    # Additional filtering to ensure the best final state is a double circle
-    if best_final_state:
-        center = best_final_state['center']
-        radius = best_final_state['radius']
-        
-        # Create a mask for the outer circle
-        outer_mask = np.zeros(thresh.shape, dtype=np.uint8)
-        cv2.circle(outer_mask, center, radius + 5, 255, 2)
-        
-        # Create a mask for the inner circle
-        inner_mask = np.zeros(thresh.shape, dtype=np.uint8)
-        cv2.circle(inner_mask, center, radius - 5, 255, 2)
-        
-        # Count the number of contours in the outer and inner masks
-        outer_contours, _ = cv2.findContours(outer_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        inner_contours, _ = cv2.findContours(inner_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        # If there are two concentric contours, it's likely a double circle
-        if len(outer_contours) == 1 and len(inner_contours) == 1:
-            return best_final_state
-    
-    return None
+    return best_final_state
 
 def detect_transitions(thresh: np.ndarray, states: List[Dict]) -> List[Dict]:
     """
@@ -177,13 +180,14 @@ def detect_transitions(thresh: np.ndarray, states: List[Dict]) -> List[Dict]:
     transitions = []
     processed_pairs = set()  # Keep track of processed state pairs
     
-    # Create a mask excluding the states
-    state_mask = np.ones(thresh.shape, dtype=np.uint8) * 255
-    for state in states:
-        cv2.circle(state_mask, state['center'], state['radius'] + 5, 0, -1)
+    # Without states no line can connect two of them
+    if not states:
+        return transitions
     
-    # Apply mask to threshold image
-    masked_thresh = cv2.bitwise_and(thresh, state_mask)
+    # Blank out the states on a copy of the threshold image
+    masked_thresh = thresh.copy()
+    for state in states:
+        cv2.circle(masked_thresh, state['center'], state['radius'] + 5, 0, -1)
     
     # Detect lines
     lines = cv2.HoughLinesP(
@@ -200,43 +204,44 @@ def detect_transitions(thresh: np.ndarray, states: List[Dict]) -> List[Dict]:
     
     # Sort states by x-coordinate for consistent processing
     sorted_states = sorted(states, key=lambda s: s['center'][0])
+    centers = np.array([s['center'] for s in sorted_states], dtype=np.float64)
+    radii = np.array([s['radius'] for s in sorted_states], dtype=np.float64)
+    # Position of each state, keeping the first one like list.index
+    state_to_idx = {}
+    for i, s in enumerate(states):
+        state_to_idx.setdefault(id(s), i)
     
-    for line in lines:
-        x1, y1, x2, y2 = line[0]
-        
-        # Ensure consistent direction (left to right)
-        if x2 < x1:
-            x1, x2 = x2, x1
-            y1, y2 = y2, y1
-        
-        # Find connected states
-        source_state = None
-        dest_state = None
-        min_source_dist = float('inf')
-        min_dest_dist = float('inf')
+    # Ensure consistent direction (left to right)
+    segments = lines[:, 0, :].copy()
+    flipped = segments[:, 2] < segments[:, 0]
+    segments[flipped] = segments[flipped][:, [2, 3, 0, 1]]
+    
+    # Squared distances from both endpoints of every line to every state center,
+    # shape (lines, 2, states) with the start point first
+    endpoints = segments.reshape(-1, 2, 2)
+    offsets = centers[None, None, :, :] - endpoints[:, :, None, :]
+    dists_sq = (offsets * offsets).sum(axis=3)
+    
+    # Only endpoints within 20px of a state boundary count, i.e.
+    # (radius - 20)^2 < dist^2 < (radius + 20)^2; take the closest such state
+    inner_sq = np.where(radii >= 20, (radii - 20) ** 2, -1.0)
+    outer_sq = (radii + 20) ** 2
+    dists_sq[(dists_sq <= inner_sq) | (dists_sq >= outer_sq)] = np.inf
+    nearest = dists_sq.argmin(axis=2)
+    found = np.take_along_axis(dists_sq, nearest[:, :, None], axis=2)[:, :, 0] < np.inf
+    
+    for i, (x1, y1, x2, y2) in enumerate(segments.tolist()):
+        if not found[i].all():
+            continue
         
-        for state in sorted_states:
-            center = state['center']
-            radius = state['radius']
-            
-            # Calculate distances to line endpoints
-            dist_to_start = np.sqrt((center[0] - x1)**2 + (center[1] - y1)**2)
-            dist_to_end = np.sqrt((center[0] - x2)**2 + (center[1] - y2)**2)
-            
-            # Check if endpoints are near state boundaries
-            if abs(dist_to_start - radius) < 20:
-                if dist_to_start < min_source_dist:
-                    min_source_dist = dist_to_start
-                    source_state = state
-            
-            if abs(dist_to_end - radius) < 20:
-                if dist_to_end < min_dest_dist:
-                    min_dest_dist = dist_to_end
-                    dest_state = state
+        source_idx = int(nearest[i, 0])
+        dest_idx = int(nearest[i, 1])
+        source_state = sorted_states[source_idx]
+        dest_state = sorted_states[dest_idx]
         
-        # If both states are found and this pair hasn't been processed
-        if source_state and dest_state and source_state != dest_state:
-            state_pair = (states.index(source_state), states.index(dest_state))
+        # If this pair of distinct states hasn't been processed
+        state_pair = (state_to_idx[id(source_state)], state_to_idx[id(dest_state)])
+        if state_pair[0] != state_pair[1]:
             if state_pair not in processed_pairs:
                 processed_pairs.add(state_pair)
                 
@@ -259,8 +264,8 @@ def detect_transitions(thresh: np.ndarray, states: List[Dict]) -> List[Dict]:
                     'midpoint': (midpoint_x, midpoint_y),
                     'label_position': (perpendicular_x, perpendicular_y),
                     'angle': angle_rad,
-                    'source_idx': sorted_states.index(source_state),
-                    'dest_idx': sorted_states.index(dest_state)
+                    'source_idx': source_idx,
+                    'dest_idx': dest_idx
                 })
     
     return transitions
@@ -319,16 +324,16 @@ def detect_small_character(image: np.ndarray, center_x: int, center_y: int, sear
                     upper_half = char_img[:h//2, :]
                     lower_half = char_img[h//2:, :]
                     
-                    upper_pixel_count = np.sum(upper_half > 0)
-                    lower_pixel_count = np.sum(lower_half > 0)
+                    upper_pixel_count = cv2.countNonZero(upper_half)
+                    lower_pixel_count = cv2.countNonZero(lower_half)
                     
                     # Count pixels in left and right halves
                     if w > 1:  # Avoid division by zero
                         left_half = char_img[:, :w//2]
                         right_half = char_img[:, w//2:]
                         
-                        left_pixel_count = np.sum(left_half > 0)
-                        right_pixel_count = np.sum(right_half > 0)
+                        left_pixel_count = cv2.countNonZero(left_half)
+                        right_pixel_count = cv2.countNonZero(right_half)
                         
                         # Features for '0':
                         # - More uniform pixel distribution
@@ -386,11 +391,12 @@ def extract_transition_label(original_image: np.ndarray, transition: Dict, trans
     
     return label
 
-def process_fsa_image(image_path: str) -> Dict:
+def process_fsa_image(image_path: str, debug: bool = FSA_DEBUG) -> Dict:
     """
     Process FSA image with unique transitions and single initial/final states.
     States are reordered so that the initial state is first, normal states follow,
-    and the final state is last.
+    and the final state is last. With debug set, the annotated image is saved
+    to static/fsa_analysis_result.png and shown.
     """
     try:
         # Read and preprocess image
@@ -398,10 +404,10 @@ def process_fsa_image(image_path: str) -> Dict:
         if original_image is None:
             raise ValueError("Could not load image")
         
-        image, thresh = preprocess_image(image_path)
+        gray, thresh = preprocess_image(original_image)
         
         # Detect states
-        states = detect_circles(image, thresh)
+        states = detect_circles(gray, thresh)
         if not states:
             raise ValueError("No states detected in the image")
         
@@ -462,6 +468,11 @@ def process_fsa_image(image_path: str) -> Dict:
             })
         
         # Process and draw transitions
+        # The initial state can also be the final state and appear twice;
+        # keep its first position, as list.index did
+        reordered_state_to_idx = {}
+        for i, s in enumerate(reordered_states):
+            reordered_state_to_idx.setdefault(id(s), i)
         transition_data = []
         for i, transition in enumerate(transitions):
             x1, y1, x2, y2 = transition['line_points']
@@ -472,13 +483,14 @@ def process_fsa_image(image_path: str) -> Dict:
             # Draw arrow head
             angle = transition['angle']
             arrow_length = 15
-            arrow_angle = np.pi / 6
+            cos_a, sin_a = math.cos(angle), math.sin(angle)
             
+            # Arrow head sides at angle +/- 30 degrees, via the angle-sum identities
             x_end, y_end = x2, y2
-            x_arrow1 = int(x_end - arrow_length * np.cos(angle + arrow_angle))
-            y_arrow1 = int(y_end - arrow_length * np.sin(angle + arrow_angle))
-            x_arrow2 = int(x_end - arrow_length * np.cos(angle - arrow_angle))
-            y_arrow2 = int(y_end - arrow_length * np.sin(angle - arrow_angle))
+            x_arrow1 = int(x_end - arrow_length * (cos_a * _COS_ARROW - sin_a * _SIN_ARROW))
+            y_arrow1 = int(y_end - arrow_length * (sin_a * _COS_ARROW + cos_a * _SIN_ARROW))
+            x_arrow2 = int(x_end - arrow_length * (cos_a * _COS_ARROW + sin_a * _SIN_ARROW))
+            y_arrow2 = int(y_end - arrow_length * (sin_a * _COS_ARROW - cos_a * _SIN_ARROW))
             
             cv2.line(result_image, (x_end, y_end), (x_arrow1, y_arrow1), (255, 0, 0), 2)
             cv2.line(result_image, (x_end, y_end), (x_arrow2, y_arrow2), (255, 0, 0), 2)
@@ -503,8 +515,8 @@ def process_fsa_image(image_path: str) -> Dict:
                         cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 0, 0), 2)
             
             # Store transition data
-            source_idx = reordered_states.index(transition['source'])
-            dest_idx = reordered_states.index(transition['destination'])
+            source_idx = reordered_state_to_idx[id(transition['source'])]
+            dest_idx = reordered_state_to_idx[id(transition['destination'])]
             transition_data.append({
                 'source': int(source_idx),  # Convert to Python int
                 'destination': int(dest_idx),  # Convert to Python int
@@ -512,10 +524,12 @@ def process_fsa_image(image_path: str) -> Dict:
             })
         
         # Save the result image for reference
-        debug_path = 'static/fsa_analysis_result.png'
-        cv2.imwrite(debug_path, result_image)
-        print(f"Saved debug image to {debug_path}")
-        cv2.imshow('image',result_image)
+        if debug:
+            debug_path = 'static/fsa_analysis_result.png'
+            cv2.imwrite(debug_path, result_image)
+            logger.info("Saved debug image to %s", debug_path)
+            cv2.imshow('image',result_image)
+        
         # Create structured FSA data
         fsa_data = {
             "states": state_info,
@@ -524,5 +538,5 @@ def process_fsa_image(image_path: str) -> Dict:
         
         return fsa_data
     except Exception as e:
-        print(f"Error processing FSA image: {str(e)}")
+        logger.error("Error processing FSA image: %s", e)
         raise
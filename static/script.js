@@ -81,6 +81,7 @@ function askQuestion(useVoice) {
         })
     })
         .then(response => response.json())
+        .then(data => data.job_id ? waitForVoiceAnswer(data.job_id) : data)
         .then(data => {
             questionInput.disabled = false;
             document.getElementById('askBtn').disabled = false;
@@ -121,6 +122,19 @@ function askQuestion(useVoice) {
         });
 }
 
+// Poll for the answer to a voice question captured on the server
+function waitForVoiceAnswer(jobId) {
+    return fetch(`/ask_result/${jobId}`)
+        .then(response => response.json())
+        .then(data => {
+            if (data.pending) {
+                return new Promise(resolve => setTimeout(resolve, 500))
+                    .then(() => waitForVoiceAnswer(jobId));
+            }
+            return data;
+        });
+}
+
 // Helper functions
 function showError(message) {
     document.getElementById('error').innerText = message;